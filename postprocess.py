@@ -1,3 +1,7 @@
+import bisect
+import functools
+import itertools
+import logging
 import re
 
 # python code that takes a list of the metadata tags, after they have
@@ -19,62 +23,73 @@ import re
 # The output will be unconditionally cleaned of empties and uniquified unless you return a list of just one item
 # (see the example at the end)
 #
-# this holds the item positions we want to drop
-# dropping cannot be done ad hoc because it would shift the positions
-delx = []
+# The filters below collect the item positions we want to drop in a set (delx) that is handed to them;
+# dropping cannot be done ad hoc because it would shift the positions.
 
-def append_to_delete(ix):
-    if ix not in delx:
-        delx.append(ix)
+# debug output goes here, it is silent unless logging is configured to show DEBUG messages
+log = logging.getLogger(__name__)
 
-def modify(items, ix_to_check, val_to_check, ix_to_modify, val_to_modify, ix_to_delete=None):
-    # modify an item in items if it is not set depending on s/th matching another item,
+
+def add_landmark(items, delx, landmarks, ix_to_check, ix_to_modify, ix_to_delete=None):
+    # modify an item in items if it is not set depending on another item being found in the landmarks dictionary,
     # optionally mark item for deletion
     #
-    # if this item matches the control value, and
-    if items[ix_to_check] == val_to_check:
+    # if this item is a key in the landmarks dictionary, and
+    landmark = landmarks.get(items[ix_to_check])
+    if landmark is not None:
         # if the item to be modified is not set,
         if not items[ix_to_modify]:
-            # modify it
-            items[ix_to_modify] = val_to_modify
+            # set it to the landmark
+            items[ix_to_modify] = landmark
         # optionally mark item[ix] for deletion
         if ix_to_delete:
-            append_to_delete(ix_to_delete)
+            delx.add(ix_to_delete)
+
 
+# S Korean provinces that are kept because they are the well-known names (the big cities and Jeju)
+s_korea_keep_provinces = frozenset({'Seoul', 'Jeju', 'Busan'})
+
+# S Korean district quarters and the landmark names we set from them
+s_korea_landmarks = {'Sanga': 'Woryeonggyo Bridge',
+                     'Pungcheon': 'Hahoe/Byeongsanseowon',
+                     'Jinhyeon': 'Bulguksa/Seokguram',
+                     'Cheongnyong': 'Beomeosa',
+                     }
 
-def pp_s_korea(items, it, ix):
+
+def pp_s_korea(items, delx, it, ix):
     # look for the item before the country ('South Korea'), it's ProvinceState
     # the structure is then Info, Quarter, District_or_City, ProvinceState, South Korea, Date, Creator
     # the offsets:          ^^^⁻4,^^^-3,   ^^^-2,            ^^^-1          ^^^we start here
     # the following assumes that the province suffix '-do' has already been regexed away
     #
     # ...in the big cities  and in Jeju, the name of the province is the well-known name, so keep it
-    if items[ix - 1] not in ["Seoul", "Jeju", "Busan"]:
+    if items[ix - 1] not in s_korea_keep_provinces:
         # ...otherwise drop the province
-        append_to_delete(ix - 1)
+        delx.add(ix - 1)
     # cut away city quarter overkill
     quarter_parts = items[ix - 3].split(' ')
     if len(quarter_parts) > 1:
         items[ix - 3] = quarter_parts[0]
     # set some landmark names from the district quarter
-    # TODO we could move this to a dict
-    modify(items, ix - 3, 'Sanga', ix - 4, 'Woryeonggyo Bridge', ix - 3)
-    modify(items, ix - 3, 'Pungcheon', ix - 4, 'Hahoe/Byeongsanseowon', ix - 3)
-    modify(items, ix - 3, 'Jinhyeon', ix - 4, 'Bulguksa/Seokguram', ix - 3)
-    modify(items, ix - 3, 'Cheongnyong', ix - 4, 'Beomeosa', ix - 3)
+    add_landmark(items, delx, s_korea_landmarks, ix - 3, ix - 4, ix - 3)
     return items
 
 
-def pp_morocco(items, it, ix):
+# Moroccan cities and the landmark names we set from them
+morocco_landmarks = {"M'Semrir": 'Gorges du Dades',
+                     'Zerkten': "Tizi n'Tichka",
+                     'Mezguita': 'Tamnougalt',
+                     'Ikniouen': 'Jbel Saghro',
+                     }
+
+
+def pp_morocco(items, delx, it, ix):
     # drop the province, except when it's Marrake([s|c]h)
     if not 'Marrakech' in items[ix - 1]:
-        append_to_delete(ix - 1)
+        delx.add(ix - 1)
     # set some landmark names from the city
-    modify(items, ix - 2, "M'Semrir", ix - 4, 'Gorges du Dades')
-    modify(items, ix - 2, "Zerkten", ix - 4, "Tizi n'Tichka")
-    modify(items, ix - 2, "Mezguita", ix - 4, "Tamnougalt")
-    modify(items, ix - 2, "Ikniouen", ix - 4, "Jbel Saghro")
-
+    add_landmark(items, delx, morocco_landmarks, ix - 2, ix - 4)
     return items
 
 
@@ -83,23 +98,21 @@ cantons = {'Zürich': 'ZH', 'Basel-Stadt': 'BS', 'St. Gallen': 'SG'}
 
 
 # Someplace, Canton of Zürich, => Someplace ZH, unless Someplace in 'Canton of Zürich'
-def pp_ch_cantons(items, ix):
-    ct = ''
-    for canton in cantons.keys():
-        # input fields
-        input_canton = items[ix - 1]
-        city = items[ix - 2]
+def pp_ch_cantons(items, delx, it, ix):
+    # input fields
+    input_canton = items[ix - 1]
+    city = items[ix - 2]
+    for canton, abbreviation in cantons.items():
         # if the dict term is in the input input_canton
         if canton in input_canton:
-            # and if the city name is not port of the dict canton
-            if city not in canton:
-                # append the canton's abbreviation
-                ct = ' ' + cantons.get(canton)
+            # update input_canton field with city + abbreviation,
+            # or just the city if the city name is part of the dict canton
+            items[ix - 1] = f"{city} {abbreviation}" if city not in canton else city
             # mark city and country field for deletion
-            append_to_delete(ix)
-            append_to_delete(ix - 2)
-            # update input_canton field with city + abbreviation (or '')
-            items[ix - 1] = city + ct
+            delx.add(ix)
+            delx.add(ix - 2)
+            # only one canton can match
+            break
     return items
 
 # This defines timespans per country (province/state,(city, (...)).
@@ -113,7 +126,8 @@ def pp_ch_cantons(items, ix):
 # This way, un-geotagged images will be associated with the country or places you visited
 # To skip items (leave them untouched), insert an empty string.
 # Existing entries will not be overwritten.
-# The start date has to be unique. Do not overlap end dates, when they do, the entry starting first wins.
+# The start date has to be unique. Timespans may overlap or be nested, e.g. to add the city for a few days
+# of a longer trip; for every item, the entry starting first wins.
 timespans = (
     ('20120812', '20120814', 'USA', 'NY', 'New York'),
     ('20120815', '20120821', 'USA', 'NY', '', 'In the Catskills'),
@@ -121,9 +135,32 @@ timespans = (
     ('20141019', '20141019', 'USA', '', 'Lake Tahoe'),
     ('20190420', '20190522', 'USA'),
     ('20200110', '20200122', 'Portugal'),
+    ('20210701', '20210731', 'Spain'),
+    ('20210710', '20210712', '', '', 'Barcelona'),
     ('20011101', '20011101', '', '', '', '', 'From Slide'),
 )
 
+
+# turn a timespan tuple into a list of (offset, value) pairs, the offset counting back from the end of the items
+# (the country, the item before the date, is at len(items)-3); empty values are left out as they change nothing
+def compile_timespan(timespan):
+    return [(offset, value) for offset, value in enumerate(timespan[2:], start=3) if value]
+
+
+# the start dates, end dates and compiled values of the timespans, sorted by start date to look them up using bisect
+# (this is done once when the script is loaded, so changes to timespans at runtime will not be seen)
+sorted_timespans = sorted(timespans)
+timespan_starts = [timespan[0] for timespan in sorted_timespans]
+timespan_ends = [timespan[1] for timespan in sorted_timespans]
+timespan_values = [compile_timespan(timespan) for timespan in sorted_timespans]
+# the latest end date of each timespan and all timespans starting before it, so that we know when to stop
+# looking back for timespans covering a date (a timespan may be inside another one)
+timespan_max_ends = list(itertools.accumulate(timespan_ends, max))
+# the overall range covered by the timespans, dates outside of it need no lookup at all
+timespans_first = min(timespan_starts, default='')
+timespans_last = max(timespan_ends, default='')
+
+
 # add information to image if the image data is inside a timespan
 def pp_metadata_from_timespan(items):
     # we assume that 'date' is the item before the last (hence the i_start is set to 2 below,
@@ -136,66 +173,69 @@ def pp_metadata_from_timespan(items):
     # we start at date, which is at len()-2                            ^^^-2
     # so our starting value is 2
     i_start = 2
-    # which gives us the position of date
-    i_pos = len(items) - i_start
+    n_items = len(items)
     # we need at least country|date|creator, so, more items than just counted from or starting point
-    if len(items) > i_start:
+    if n_items > i_start:
         # let's look at what's at the date position and try to
         # get the strings for day, month, year (input format m-d-yyyy)
         # this should give us M, D, YYYY @ 0, 1, 2
-        i_date_list = items[i_pos].split('-')
+        i_date_list = items[n_items - i_start].split('-')
         # without 3 items, it's not a correct date (this is only _very_ basic error checking)
         if len(i_date_list) == 3:
+            month, day, year = i_date_list
             # convert the date string to YYYYMMDD to make it sortable (add leading zeros if necessary)
-            i_date = i_date_list[2] + i_date_list[0].zfill(2) + i_date_list[1].zfill(2)
-            for timespan in timespans:
-                # make timespan tuple iterable
-                timespan_iter = iter(timespan)
-                # get first tuple from the timespans
-                # to compare with the item's date
-                start_date = next(timespan_iter)
-                if i_date >= start_date:
-                    end_date = next(timespan_iter)
-                    if i_date <= end_date:
-                        # we have a hit on the timespan
-                        # now, move the position to the item before the date (should be 'country')
-                        i_pos = i_pos - 1
-                        # don't wrap around the item list (this catches and ignores too many items in timespan tuple)
-                        while i_pos >= 0:
-                            # this try block catches the end of the timespan tuple because it will be left if there's
-                            # no more 'next'
-                            try:
-                                # work through the timespan tuple:
-                                # get the next new item from the timespan tuple...
-                                new_item = next(timespan_iter)
-                                # ...set the metadata item from the timespan item if it isn't set already
-                                # (and is not empty)...
-                                if not items[i_pos]:
-                                    items[i_pos] = new_item
-                                # ...move our item pointer to the previous item (we're going backward)
-                                i_pos = i_pos - 1
-                            except StopIteration:
-                                # no more items in tuple, so we're done
-                                break
+            i_date = f"{year}{month.zfill(2)}{day.zfill(2)}"
+            # nothing to do if the image date is outside of all timespans
+            if i_date < timespans_first or i_date > timespans_last:
+                return items
+            # find the last timespan starting on or before the image date, and from there, look back for all
+            # timespans covering the image date, as long as there can be any
+            hits = []
+            ts_ix = bisect.bisect_right(timespan_starts, i_date) - 1
+            while ts_ix >= 0 and i_date <= timespan_max_ends[ts_ix]:
+                if i_date <= timespan_ends[ts_ix]:
+                    hits.append(ts_ix)
+                ts_ix = ts_ix - 1
+            # we have a hit on the timespans, work through their values, going backward through the items
+            # (the timespan starting first goes first, so it wins as existing entries will not be overwritten)
+            for ts_ix in reversed(hits):
+                for offset, new_item in timespan_values[ts_ix]:
+                    i_pos = n_items - offset
+                    # don't wrap around the item list (this catches and ignores too many items in timespan tuple)
+                    if i_pos < 0:
+                        break
+                    # set the metadata item from the timespan item if it isn't set already
+                    if not items[i_pos]:
+                        items[i_pos] = new_item
     return (items)
-# consume the rest of the timespan after country
 
 # for slides we delete all info that may have been set from the camera's GPS
-def pp_dia():
-    for i in [1, 2, 3, 4, 5]:
-        append_to_delete(i)
+def pp_dia(delx):
+    delx.update([1, 2, 3, 4, 5])
 
 
-# global replacements: the dictionary has keys (to look up) and replacement values.
-def pp_glob(items, glob_replacements):
+# global replacements: a list of functions, each one replacing a key by its value in a string.
+def pp_glob(items, glob_replacers):
     for i, it in enumerate(items):
-        for key, value in glob_replacements.items():
+        for replace in glob_replacers:
             # update the working value to prevent regressions when multiple matches occur
-            it = re.sub(key, value, it)
-            items[i] = it
+            it = replace(it)
+        items[i] = it
     return items
 
 
+# characters with a special meaning in regular expressions
+regex_special_chars = frozenset('.^$*+?{}[]\\|()')
+
+
+def compile_replacement(key, value):
+    # plain strings (no regex special characters in the key, no escapes in the value) are
+    # replaced using str.replace, which is a lot faster than running them through the regex engine
+    if regex_special_chars.isdisjoint(key) and '\\' not in value:
+        return lambda it: it.replace(key, value)
+    return functools.partial(re.compile(key).sub, value)
+
+
 # value/replacement dictionary
 # these will be replaced wherever they occur
 # regular expressions [https://docs.python.org/3/library/re.html] are allowed
@@ -206,39 +246,45 @@ glob_replacements = {'Zurich': 'Zürich',
                      ' Province': '',
                      }
 
+# the replacement functions, compiled once when the script is loaded
+glob_replacers = [compile_replacement(key, value) for key, value in glob_replacements.items()]
+
 
-# main filter
-def postprocess(items: [str], sep: str) -> str:
+# the filters to call when an item matches a country name
+country_filters = {'South Korea': pp_s_korea,
+                   'Morocco': pp_morocco,
+                   'Switzerland': pp_ch_cantons,
+                   }
+
+
+# main filter (works on and returns a list, which it may modify in place)
+def pp_items(items: [str], sep: str) -> [str]:
     outitems = []
-    # clear the drop list
-    delx.clear()
+    # the item positions to drop
+    delx = set()
     # first, replace the global stuff
-    items = pp_glob(items, glob_replacements)
+    items = pp_glob(items, glob_replacers)
     # get metadata from timespans
     # (if it was me who photographed)
     # if 'Hartmut' in items[len(items)-1]:
     items = pp_metadata_from_timespan(items)
-    print(items)
+    log.debug("%r", items)
     # now the specific filters
     for ix, it in enumerate(items):
         if 'From Slide' in it:
-            pp_dia()
+            pp_dia(delx)
             outitems = items
-        if it == "South Korea":
-            outitems = pp_s_korea(items, it, ix)
-        if it == "Morocco":
-            outitems = pp_morocco(items, it, ix)
-        if it == "Switzerland":
-            outitems = pp_ch_cantons(items, ix)
+        country_filter = country_filters.get(it)
+        if country_filter is not None:
+            outitems = country_filter(items, delx, it, ix)
 
     if not outitems:
-        print("Status line unfiltered.")
+        log.debug("Status line unfiltered.")
     else:
-        # only now, we remove the dropped items
-        for x in sorted(delx, reverse=True):
-            del outitems[x]
-        print("Status line changed to:")
-        print(outitems)
+        # only now, we remove the dropped items (in a single pass, so positions don't shift)
+        if delx:
+            outitems = [item for ix, item in enumerate(outitems) if ix not in delx]
+        log.debug("Status line changed to: %r", outitems)
         items = outitems
 
     # if you return a list of items, the final processing will cause empties to be filtered out and
@@ -251,6 +297,19 @@ def postprocess(items: [str], sep: str) -> str:
     # return [sep.join(filter(lambda x: len(x) > 0, items))]
 
 
+# the filters only depend on their input, so we remember the results for images we have already seen
+# (e.g. when the slideshow comes around again); the cache holds immutable tuples, so it cannot be
+# changed by the filters or by the caller
+@functools.lru_cache(maxsize=1024)
+def postprocess_cached(items: tuple, sep: str) -> tuple:
+    return tuple(pp_items(list(items), sep))
+
+
+# entry point called by Rust
+def postprocess(items: [str], sep: str) -> [str]:
+    return list(postprocess_cached(tuple(items), sep))
+
+
 def export():
     # return callable to Rust code
     return postprocess
@@ -1,5 +1,8 @@
 #!/usr/bin/pytest-3
 # import pytest
+import datetime
+import re
+
 import postprocess
 
 # These tests assume the example file postprocess.py
@@ -47,6 +50,25 @@ def test_glob4():
     assert put_out(input) == "Zürich|SubLocation|Location|Zürich|Country|1.11.2001|Creator"
 
 
+def test_glob5():
+    # regex keys and backreferences go through the regex engine, plain keys don't,
+    # and the results are the same as replacing them in order using re.sub
+    replacements = {r' \(.*\)': '',
+                    r'(\w+)-do$': r'\1',
+                    'Zurich': 'Zürich',
+                    'Zürich Oerlikon': 'Oerlikon',
+                    }
+    replacers = [postprocess.compile_replacement(key, value) for key, value in replacements.items()]
+    items = ["Gyeongsangbuk-do", "Zurich Oerlikon (Station)", "Location (Old Town)", "Zurich"]
+    expected = []
+    for it in items:
+        for key, value in replacements.items():
+            it = re.sub(key, value, it)
+        expected.append(it)
+    assert postprocess.pp_glob(list(items), replacers) == expected == \
+           ["Gyeongsangbuk", "Oerlikon", "Location", "Zürich"]
+
+
 # we have to make up a test for every filtered item of input
 # now, we have Dia, Südkorea, Mark, Marokko, Schweiz
 
@@ -195,3 +217,39 @@ def test_timeline8():
 # '19141008': {'19141008': {'USA': {'PA': {'Philadelphia': {'30th Street Station':{ 'Something':{ 'This here is too much': None}}}}}}},
 #        input = "||||8.10.1914|Creator"
 #        print(put_out(input))
+
+
+def test_timeline10():
+    # dates just before the first and just after the last timespan, and far outside of them
+    # these should return unchanged
+    one_day = datetime.timedelta(days=1)
+    first = datetime.datetime.strptime(postprocess.timespans_first, "%Y%m%d")
+    last = datetime.datetime.strptime(postprocess.timespans_last, "%Y%m%d")
+    for date in [first - one_day, last + one_day, first - 1000 * one_day, last + 1000 * one_day]:
+        input = "Name|SubLocation|Location|ProvinceState||" + date.strftime("%m-%d-%Y") + "|Creator"
+        assert put_out(input) == input
+
+
+def test_timeline11():
+    # a timespan inside another one (a few days in Barcelona during the Spain trip)
+    # outside of the inner timespan, only the outer one should be used
+    input = "Name|SubLocation||ProvinceState||07-20-2021|Creator"
+    assert put_out(input) == "Name|SubLocation||ProvinceState|Spain|07-20-2021|Creator"
+    # inside both, both are used, the timespan starting first wins for every item
+    input = "Name|SubLocation||ProvinceState||07-11-2021|Creator"
+    assert put_out(input) == "Name|SubLocation|Barcelona|ProvinceState|Spain|07-11-2021|Creator"
+
+
+def test_cache():
+    # results are cached, but neither the caller's list nor a returned list can change what's in the cache
+    items = "Name|SubLocation|Location|Zurich||08-13-2012|Creator".split(sep)
+    first = postprocess.postprocess(items, sep)
+    assert items == "Name|SubLocation|Location|Zurich||08-13-2012|Creator".split(sep)
+    first[0] = "Changed"
+    items[1] = "Changed"
+    hits = postprocess.postprocess_cached.cache_info().hits
+    second = postprocess.postprocess("Name|SubLocation|Location|Zurich||08-13-2012|Creator".split(sep), sep)
+    # the second call has to come from the cache...
+    assert postprocess.postprocess_cached.cache_info().hits == hits + 1
+    # ...and be unaffected by the changes above
+    assert second == "Name|SubLocation|Location|Zürich|USA|08-13-2012|Creator".split(sep)